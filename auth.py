@@ -1,32 +1,56 @@
 """
-auth.py — Passlib/bcrypt şifre hashing + itsdangerous imzalı cookie session.
+auth.py — bcrypt şifre hashing + itsdangerous imzalı cookie session.
 """
 from __future__ import annotations
 
+import asyncio
 import os
-import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
+import bcrypt
 from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
-from passlib.context import CryptContext
 from fastapi import Cookie, HTTPException, status
 
-from db import get_conn
+from db import acquire, tuple_cursor
 
 # ── Crypto setup ───────────────────────────────────────────────────────────────
 SECRET_KEY: str = os.environ.get("SECRET_KEY", os.urandom(32).hex())
 _signer = URLSafeTimedSerializer(SECRET_KEY, salt="session")
-_pwd_ctx = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__truncate_error=False)
+BCRYPT_ROUNDS = 12
 SESSION_MAX_AGE = 60 * 60 * 24 * 30  # 30 gün
 
+# bcrypt CPU-yoğun; event loop'u ve Starlette'in ortak threadpool'unu
+# meşgul etmemesi için çekirdek sayısı kadar ayrı worker'da çalışır.
+# bcrypt wheel'i hash sırasında GIL'i bıraktığı için thread yeterli.
+_bcrypt_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="bcrypt")
+
 
 # ── Password helpers ───────────────────────────────────────────────────────────
+def _pw_bytes(plain: str) -> bytes:
+    # bcrypt yalnızca ilk 72 byte'ı kullanır.
+    return plain.encode("utf-8")[:72]
+
+
 def hash_password(plain: str) -> str:
-    return _pwd_ctx.hash(plain[:72])
+    return bcrypt.hashpw(_pw_bytes(plain), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode("ascii")
 
 
 def verify_password(plain: str, hashed: str) -> bool:
-    return _pwd_ctx.verify(plain[:72], hashed)
+    try:
+        return bcrypt.checkpw(_pw_bytes(plain), hashed.encode("ascii"))
+    except ValueError:
+        return False
+
+
+# Bilinmeyen e-postada da tam bir bcrypt doğrulaması yapılır (kullanıcı var/yok
+# zamanlama farkı oluşmaz); dummy hash import'ta bir kez üretilir.
+_DUMMY_HASH = hash_password("x" * 8)
+
+
+def verify_or_dummy(plain: str, hashed: Optional[str]) -> bool:
+    ok = verify_password(plain, hashed or _DUMMY_HASH)
+    return ok and hashed is not None
 
 
 # ── Session cookie ─────────────────────────────────────────────────────────────
@@ -42,34 +66,47 @@ def decode_session_cookie(token: str) -> Optional[int]:
 
 
 # ── DB helpers ─────────────────────────────────────────────────────────────────
+# users.email COLLATE NOCASE: büyük/küçük harf eşlemesi index'te yapılır.
+SQL_INSERT_USER = (
+    "INSERT INTO users(email, hashed_pw) VALUES(?,?) "
+    "ON CONFLICT(email) DO NOTHING RETURNING id"
+)
+SQL_USER_CREDENTIALS = "SELECT id, hashed_pw FROM users WHERE email=?"
+
+
+def _norm_email(email: str) -> str:
+    # NOCASE yalnızca ASCII harfleri katlar; .lower() ASCII dışı büyük/küçük harfi de eşler.
+    return email.strip().lower()
+
+
 def create_user(email: str, plain_password: str) -> int:
-    conn = get_conn()
-    cur = conn.cursor()
-    try:
-        cur.execute(
-            "INSERT INTO users(email, hashed_pw) VALUES(?,?)",
-            (email.strip().lower(), hash_password(plain_password)),
-        )
+    hashed = hash_password(plain_password)
+    with acquire(readonly=False) as conn:
+        # Tek ifade: çakışmada satır dönmez, exception/ek SELECT gerekmez.
+        row = tuple_cursor(conn).execute(SQL_INSERT_USER, (_norm_email(email), hashed)).fetchone()
         conn.commit()
-        return cur.lastrowid
-    except sqlite3.IntegrityError:
+    if row is None:
         raise ValueError("Bu e-posta adresi zaten kayıtlı.")
-    finally:
-        conn.close()
+    return row[0]
 
 
 def authenticate_user(email: str, plain_password: str) -> Optional[int]:
-    conn = get_conn()
-    row = conn.execute(
-        "SELECT id, hashed_pw FROM users WHERE email=?",
-        (email.strip().lower(),),
-    ).fetchone()
-    conn.close()
-    if row is None:
+    with acquire() as conn:
+        row = tuple_cursor(conn).execute(SQL_USER_CREDENTIALS, (_norm_email(email),)).fetchone()
+    user_id, hashed = row if row else (None, None)
+    if not verify_or_dummy(plain_password, hashed):
         return None
-    if not verify_password(plain_password, row["hashed_pw"]):
-        return None
-    return int(row["id"])
+    return user_id
+
+
+async def create_user_async(email: str, plain_password: str) -> int:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_bcrypt_pool, create_user, email, plain_password)
+
+
+async def authenticate_user_async(email: str, plain_password: str) -> Optional[int]:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_bcrypt_pool, authenticate_user, email, plain_password)
 
 
 # ── FastAPI dependency ─────────────────────────────────────────────────────────
@@ -0,0 +1,91 @@
+"""
+calc.py — Stok hesapları (günlük hız, güvenlik stoğu, ROP, sipariş miktarı)
+"""
+from __future__ import annotations
+
+import math
+from types import MappingProxyType
+from typing import List, Mapping, Sequence, Tuple
+
+# Lead time küçük bir tamsayı aralığında (gün); sqrt(max(1, lt)) tablodan okunur.
+_SQRT_LT = tuple(math.sqrt(max(1, i)) for i in range(366))
+
+
+# Satışı olmayan (uzun kuyruk) SKU'lar için paylaşılan, salt-okunur sonuç.
+_ZERO_RESULT = MappingProxyType({
+    "daily_velocity": 0.0,
+    "std_daily": 0.0,
+    "safety_stock": 0.0,
+    "rop": 0.0,
+    "order_qty": 0.0,
+})
+
+
+def _plan(lead_time: int, z: float, n: int, mean_month: float, m2: float,
+          fba_stock: int, inbound_stock: int) -> Mapping[str, float]:
+    if n == 0 or (mean_month == 0.0 and fba_stock + inbound_stock >= 0):
+        return _ZERO_RESULT
+    daily_velocity = mean_month / 30.0
+    std_daily = math.sqrt(m2 / (n - 1)) / 30.0 if n >= 2 else 0.0
+    sqrt_lt = _SQRT_LT[lead_time] if 0 <= lead_time < 366 else math.sqrt(max(1, lead_time))
+    safety_stock = z * std_daily * sqrt_lt
+    rop = daily_velocity * lead_time + safety_stock
+    order_qty = max(
+        0.0,
+        daily_velocity * 60 + safety_stock - (fba_stock + inbound_stock),
+    )
+    return {
+        "daily_velocity": daily_velocity,
+        "std_daily": std_daily,
+        "safety_stock": safety_stock,
+        "rop": rop,
+        "order_qty": order_qty,
+    }
+
+
+def _moments(monthly_units: List[int]) -> Tuple[int, float, float]:
+    # Welford: ortalama ve varyans tek geçişte (statistics.stdev'in Fraction yolu yok).
+    n = 0
+    mean = 0.0
+    m2 = 0.0
+    for x in monthly_units:
+        n += 1
+        delta = x - mean
+        mean += delta / n
+        m2 += delta * (x - mean)
+    return n, mean, m2
+
+
+def compute_from_last_months(
+    lead_time: int,
+    z: float,
+    monthly_units: List[int],
+    fba_stock: int,
+    inbound_stock: int,
+) -> Mapping[str, float]:
+    return _plan(lead_time, z, *_moments(monthly_units), fba_stock, inbound_stock)
+
+
+def _moments_from_sums(n: int, total: int, total_sq: int) -> Tuple[int, float, float]:
+    # SQL'den gelen COUNT/SUM/SUM(x²); tamsayı aritmetiği olduğu için M2 kesin.
+    if n == 0:
+        return 0, 0.0, 0.0
+    return n, total / n, (n * total_sq - total * total) / n
+
+
+def compute_batch(
+    lead_times: Sequence[int],
+    zs: Sequence[float],
+    counts: Sequence[int],
+    totals: Sequence[int],
+    totals_sq: Sequence[int],
+    fba_stocks: Sequence[int],
+    inbound_stocks: Sequence[int],
+) -> List[Mapping[str, float]]:
+    """Tüm SKU'lar için tek geçiş; girdiler SKU sırasına göre paralel kolonlar."""
+    return [
+        _plan(lt, z, *_moments_from_sums(n, t, tsq), fba, inb)
+        for lt, z, n, t, tsq, fba, inb in zip(
+            lead_times, zs, counts, totals, totals_sq, fba_stocks, inbound_stocks
+        )
+    ]
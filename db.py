@@ -1,59 +1,205 @@
 import sqlite3
+import threading
+from contextlib import contextmanager
+from queue import Empty, LifoQueue
+from typing import Iterator, Optional
 
 DB_NAME = "amazon_planner.db"
+READ_POOL_MIN = 2
+READ_POOL_MAX = 8
 
+# Tek betik: şema tek seferde parse edilir ve tek COMMIT ile yazılır.
+_SCHEMA = """
+BEGIN;
 
-def get_conn() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_NAME, check_same_thread=False)
+-- ── Users ──────────────────────────────────────────────────────────────────────
+CREATE TABLE IF NOT EXISTS users (
+    id       INTEGER PRIMARY KEY AUTOINCREMENT,
+    email    TEXT    NOT NULL UNIQUE COLLATE NOCASE CHECK(email = trim(email)),
+    hashed_pw TEXT   NOT NULL,
+    created_at TEXT  DEFAULT CURRENT_TIMESTAMP
+);
+
+-- ── Products ───────────────────────────────────────────────────────────────────
+CREATE TABLE IF NOT EXISTS products (
+    id             INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id        INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    sku            TEXT    NOT NULL,
+    name           TEXT    DEFAULT '',
+    lead_time_days INTEGER NOT NULL,
+    z_value        REAL    NOT NULL,
+    fba_stock      INTEGER NOT NULL DEFAULT 0,
+    inbound_stock  INTEGER NOT NULL DEFAULT 0,
+    updated_at     TEXT    DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now')),
+    UNIQUE(user_id, sku)
+);
+
+-- ── Monthly Sales ──────────────────────────────────────────────────────────────
+CREATE TABLE IF NOT EXISTS monthly_sales (
+    id         INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id    INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    sku        TEXT    NOT NULL,
+    year       INTEGER NOT NULL,
+    month      INTEGER NOT NULL CHECK(month BETWEEN 1 AND 12),
+    units_sold INTEGER NOT NULL CHECK(units_sold >= 0),
+    created_at TEXT    DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now')),
+    UNIQUE(user_id, sku, year, month)
+);
+
+-- ── Data version ───────────────────────────────────────────────────────────────
+-- Kullanıcı başına sayaç; ürün/satış yazan her transaction artırır (ETag için).
+CREATE TABLE IF NOT EXISTS user_data_version (
+    user_id INTEGER PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+    version INTEGER NOT NULL DEFAULT 0
+);
+
+-- units_sold dahil: son-N-ay toplamları tablo satırına inmeden index'ten okunur.
+CREATE INDEX IF NOT EXISTS idx_ms_user_sku_ym
+    ON monthly_sales(user_id, sku, year DESC, month DESC, units_sold);
+
+-- /products, /plan ve export'lar "ORDER BY updated_at DESC" ile listelenir.
+CREATE INDEX IF NOT EXISTS idx_products_user_updated
+    ON products(user_id, updated_at DESC);
+
+COMMIT;
+"""
+
+
+_wal_enabled = False
+
+
+def _connect(readonly: bool = False) -> sqlite3.Connection:
+    global _wal_enabled
+    # cached_statements: aynı SQL metni havuzdaki bağlantıda yeniden derlenmez.
+    conn = sqlite3.connect(DB_NAME, check_same_thread=False, cached_statements=256)
     conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA journal_mode=WAL;")
-    conn.execute("PRAGMA foreign_keys=ON;")
+    # journal_mode dosyada kalıcı; süreç başına bir kez ayarlamak yeterli.
+    if not _wal_enabled:
+        conn.execute("PRAGMA journal_mode=WAL;")
+        _wal_enabled = True
+    # Bağlantı havuzda uzun yaşadığı için PRAGMA'lar yalnızca bir kez çalışır.
+    conn.executescript("""
+        PRAGMA busy_timeout=5000;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA cache_size=-65536;
+        PRAGMA mmap_size=268435456;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA foreign_keys=ON;
+    """)
+    if readonly:
+        conn.execute("PRAGMA query_only=ON;")
+    else:
+        # Örtük transaction'lar BEGIN IMMEDIATE ile açılır: yazma kilidi baştan
+        # alınır, upsert ortasında SQLITE_BUSY ile düşülmez.
+        conn.isolation_level = "IMMEDIATE"
     return conn
 
 
-def init_db() -> None:
-    conn = get_conn()
-    cur = conn.cursor()
+class _Pool:
+    """Süreç boyunca açık tutulan sqlite bağlantıları (LIFO → sıcak page cache).
 
-    # ── Users ──────────────────────────────────────────────────────────────────
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        id       INTEGER PRIMARY KEY AUTOINCREMENT,
-        email    TEXT    NOT NULL UNIQUE COLLATE NOCASE,
-        hashed_pw TEXT   NOT NULL,
-        created_at TEXT  DEFAULT CURRENT_TIMESTAMP
-    );
-    """)
+    En fazla `size` bağlantı açılır; hepsi kullanımdaysa `get` biri geri
+    gelene kadar bekler.
+    """
 
-    # ── Products ───────────────────────────────────────────────────────────────
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS products (
-        id             INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id        INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-        sku            TEXT    NOT NULL,
-        name           TEXT    DEFAULT '',
-        lead_time_days INTEGER NOT NULL,
-        z_value        REAL    NOT NULL,
-        fba_stock      INTEGER NOT NULL DEFAULT 0,
-        inbound_stock  INTEGER NOT NULL DEFAULT 0,
-        updated_at     TEXT    DEFAULT CURRENT_TIMESTAMP,
-        UNIQUE(user_id, sku)
-    );
-    """)
+    def __init__(self, size: int, readonly: bool) -> None:
+        self._size = size
+        self._readonly = readonly
+        self._idle: LifoQueue = LifoQueue(maxsize=size)
+        self._lock = threading.Lock()
+        self._opened = 0
 
-    # ── Monthly Sales ──────────────────────────────────────────────────────────
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS monthly_sales (
-        id         INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id    INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-        sku        TEXT    NOT NULL,
-        year       INTEGER NOT NULL,
-        month      INTEGER NOT NULL CHECK(month BETWEEN 1 AND 12),
-        units_sold INTEGER NOT NULL CHECK(units_sold >= 0),
-        created_at TEXT    DEFAULT CURRENT_TIMESTAMP,
-        UNIQUE(user_id, sku, year, month)
-    );
-    """)
+    def _open(self) -> Optional[sqlite3.Connection]:
+        with self._lock:
+            if self._opened >= self._size:
+                return None
+            self._opened += 1
+        try:
+            return _connect(self._readonly)
+        except sqlite3.Error:
+            with self._lock:
+                self._opened -= 1
+            raise
+
+    def fill(self, n: int) -> None:
+        for _ in range(n):
+            conn = self._open()
+            if conn is None:
+                break
+            self._idle.put_nowait(conn)
+
+    def get(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except Empty:
+            pass
+        return self._open() or self._idle.get()
 
+    def put(self, conn: sqlite3.Connection) -> None:
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put_nowait(conn)
+
+    def close(self) -> None:
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._opened -= 1
+
+
+# SQLite tek yazar: yazma işleri tek bağlantıda sıraya girer, okumalar
+# (query_only) ayrı havuzdan paralel yürür.
+_readers = _Pool(READ_POOL_MAX, readonly=True)
+_writer = _Pool(1, readonly=False)
+
+
+def open_pools() -> None:
+    _readers.fill(READ_POOL_MIN)
+    _writer.fill(1)
+
+
+def _refresh_stats(conn: sqlite3.Connection) -> None:
+    """Planlayıcı istatistiklerini (sqlite_stat1) sınırlı maliyetle tazeler."""
+    conn.execute("PRAGMA analysis_limit=400;")
+    if sqlite3.sqlite_version_info >= (3, 46):
+        # 0x10000: yalnızca bu bağlantının sorguladığı tablolar değil, hepsi kontrol edilir.
+        conn.execute("PRAGMA optimize=0x10002;")
+    else:
+        # Eski sürümlerde optimize yalnızca bu bağlantıda sorgulanan tablolara bakar;
+        # DDL çalıştırmış yazar bağlantısında hiçbir şey yapmaz → sınırlı ANALYZE.
+        conn.execute("ANALYZE;")
     conn.commit()
-    conn.close()
+
+
+def close_pools() -> None:
+    _readers.close()
+    with acquire(readonly=False) as conn:
+        _refresh_stats(conn)
+    _writer.close()
+
+
+@contextmanager
+def acquire(readonly: bool = True) -> Iterator[sqlite3.Connection]:
+    pool = _readers if readonly else _writer
+    conn = pool.get()
+    try:
+        yield conn
+    finally:
+        pool.put(conn)
+
+
+def tuple_cursor(conn: sqlite3.Connection) -> sqlite3.Cursor:
+    """sqlite3.Row yerine düz tuple döndüren cursor (az kolonlu sıcak sorgular için)."""
+    cur = conn.cursor()
+    cur.row_factory = None
+    return cur
+
+
+def init_db() -> None:
+    with acquire(readonly=False) as conn:
+        conn.executescript(_SCHEMA)
+        _refresh_stats(conn)